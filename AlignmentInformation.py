@@ -24,6 +24,12 @@ class AlignmentInformation(object):
         List of names of alleles in the reference alignment
     processed_reads_dictionary : dict
         Dictionary that stores already processed reads as keys. Values are length based positions ranges of the reads
+    unique_alignments_dictionary : dict
+        Used when duplicate reads are collapsed. Keys are (leftmost position, cigar string, sequence) tuples, values
+        store the aligned sequence, rightmost position and exon overlap of that alignment, decoded only once
+    collapsed_reads_dictionary : dict
+        Used when duplicate reads are collapsed. Keys are unique alignment keys extended with the position range of the
+        already processed paired-end read (None if there is none), values are the number of reads (weight) sharing them
     count_dataframe : pandas dataframe
         count_dictionary converted into a pandas dataframe, for manual inspection
     proportion_dataframe : pandas dataframe
@@ -34,6 +40,13 @@ class AlignmentInformation(object):
     update_count_dictionary
         Takes a class Read instance as an argument and updates the count_dictionary
         It considers if the given read is overlapping with its paired-end, to avoid repetition
+    add_to_count_dictionary
+        Adds an aligned sequence to the count_dictionary with a weight, skipping positions of its paired-end read
+    collapse_read
+        Takes a class Read instance as an argument and accounts it as a duplicate of identical alignments, decoding
+        its cigar only the first time that alignment is found
+    update_collapsed_reads
+        Updates the count_dictionary once per collapsed alignment, weighted by its number of reads
     create_proportion_dictionary
         Creates a proportion_dictionary out of count_dictionary. Per position in count_dictionary, it calculates the
         proportions of every nucleotide.
@@ -61,14 +74,10 @@ class AlignmentInformation(object):
             for i in range(exon_range[0], exon_range[1]):
                 self.count_dictionary[i] = {"A": 0.0, "T": 0.0, "G": 0.0, "C": 0.0, ".": 0.0}
 
-        self.reference_alleles = []
-        with open(self.reference.file_name) as alignment_reference:
-            for allele in alignment_reference.readlines()[12:-1]:  # First sequence in reference starts in line 12
-                allele = allele.replace(" ", "")
-                allele_id = allele.split("\t")[0]
-                self.reference_alleles.append(allele_id)
-        alignment_reference.close()
+        self.reference_alleles = list(self.reference.get_allele_sequences().keys())
         self.processed_reads_dictionary = {}
+        self.unique_alignments_dictionary = {}
+        self.collapsed_reads_dictionary = {}
 
     def update_count_dictionary(self, a_read_instance):
         """Takes a class Read instance, check whether this read's pair was already processed
@@ -84,23 +93,93 @@ class AlignmentInformation(object):
         If a nucleotide is defined as "N", no information is updated to the count_dictionary in that position
         """
 
-        position = a_read_instance.leftmost_position
         if a_read_instance.id in self.processed_reads_dictionary:
-            paired_read_range = set(range(a_read_instance.leftmost_position, a_read_instance.rightmost_position))
-            paired_reads_overlapping_positions = paired_read_range.intersection(
-                range(self.processed_reads_dictionary[a_read_instance.id][0],
-                      self.processed_reads_dictionary[a_read_instance.id][1]))
+            paired_read_range = self.processed_reads_dictionary[a_read_instance.id]
         else:
             self.processed_reads_dictionary[a_read_instance.id] = [a_read_instance.leftmost_position,
                                                                    a_read_instance.rightmost_position]
-            paired_reads_overlapping_positions = []
-        for nucleotide in a_read_instance.aligned_sequence:
+            paired_read_range = None
+        self.add_to_count_dictionary(a_read_instance.leftmost_position, a_read_instance.aligned_sequence,
+                                     paired_read_range)
+
+    def add_to_count_dictionary(self, leftmost_position, aligned_sequence, paired_read_range=None, weight=1):
+        """Adds the nucleotides of an aligned sequence to count_dictionary, each one counted weight times.
+        Positions within the range of the already processed paired-end read are skipped
+
+        Parameters
+        ----------
+        leftmost_position : int
+            Position of the reference alignment to which the first nucleotide of aligned_sequence is aligned
+        aligned_sequence : list
+            Aligned sequence of a read, as given by class Read method get_aligned_sequence
+        paired_read_range : list/tuple
+            Leftmost and rightmost positions of the already processed paired-end read, None if there is none
+        weight : int
+            Number of reads with this same alignment
+
+        Raises
+        ------
+        If a nucleotide is defined as "N", no information is updated to the count_dictionary in that position
+        """
+
+        position = leftmost_position
+        for nucleotide in aligned_sequence:
             if nucleotide == "N":
                 pass
-            elif position in self.count_dictionary and position not in paired_reads_overlapping_positions:
-                self.count_dictionary[position][nucleotide] += 1
+            elif position in self.count_dictionary and (paired_read_range is None or
+                                                        not paired_read_range[0] <= position < paired_read_range[1]):
+                self.count_dictionary[position][nucleotide] += weight
             position += 1
 
+    def collapse_read(self, a_read_instance):
+        """Takes a class Read instance, with its cigar not parsed yet, and accounts it as one more read of its
+        alignment (leftmost position, cigar and sequence). Cigar parsing, aligned sequence and exon overlap are only
+        computed the first time an alignment is found. Reads not aligned to exons are not accounted.
+        Paired-end reads keep their overlap semantics, as the range of the processed paired-end read is part of the
+        collapsed key. Method update_collapsed_reads must be called after every read is collapsed
+
+        Parameters
+        ----------
+        a_read_instance
+            Instance inherited from class Read
+        """
+
+        alignment_key = (a_read_instance.leftmost_position, "".join(a_read_instance.cigar_lst),
+                         a_read_instance.sequence)
+        if alignment_key not in self.unique_alignments_dictionary:
+            a_read_instance.parse_cigar()
+            a_read_instance.get_aligned_sequence()
+            in_exons = False
+            for exon_range in self.reference.exons_index_list:
+                if a_read_instance.is_aligned_to(exon_range) is True:  # Only exon information is accounted
+                    in_exons = True
+                    break
+            self.unique_alignments_dictionary[alignment_key] = [a_read_instance.aligned_sequence,
+                                                                a_read_instance.rightmost_position, in_exons]
+        aligned_sequence, rightmost_position, in_exons = self.unique_alignments_dictionary[alignment_key]
+        if in_exons is False:
+            return
+
+        if a_read_instance.id in self.processed_reads_dictionary:
+            paired_read_range = tuple(self.processed_reads_dictionary[a_read_instance.id])
+        else:
+            self.processed_reads_dictionary[a_read_instance.id] = [a_read_instance.leftmost_position,
+                                                                   rightmost_position]
+            paired_read_range = None
+        collapsed_key = alignment_key + (paired_read_range,)
+        self.collapsed_reads_dictionary[collapsed_key] = self.collapsed_reads_dictionary.get(collapsed_key, 0) + 1
+
+    def update_collapsed_reads(self):
+        """Updates count_dictionary once per collapsed alignment, weighted by the number of reads sharing it.
+        Collapsed reads are emptied afterwards, so they are not accounted twice
+
+        """
+
+        for collapsed_key, weight in self.collapsed_reads_dictionary.items():
+            aligned_sequence = self.unique_alignments_dictionary[collapsed_key[:3]][0]
+            self.add_to_count_dictionary(collapsed_key[0], aligned_sequence, collapsed_key[3], weight)
+        self.collapsed_reads_dictionary = {}
+
     def create_proportion_dictionary(self):
         """Creates a proportion_dictionary out of count_dictionary. Per position in dictionary, it calculates the
         proportions of every nucleotide. Proportions are rounded up to two decimals.
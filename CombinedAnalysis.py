@@ -1,5 +1,9 @@
 import itertools as it
 import numpy as np
+import hashlib
+import json
+import os
+from collections import OrderedDict
 
 
 class CombinedAnalysis(object):
@@ -12,7 +16,9 @@ class CombinedAnalysis(object):
     ----------
     all_genotype_combinations : list of lists of tuples
         All possible genotype combinations (every list inside the final list)
-        of 2 alleles (every tuple inside every list) per detected KIR gene
+        of 2 alleles (every tuple inside every list) per detected KIR gene. Left empty when results come from a cache
+    primary_combinations : int
+        Number of all possible genotype combinations, computed without creating them
     coding_sequences_per_position : dictionary of dictionaries
         Per exon position, it stores nucleotide information from every result allele from class Progressive Analysis
     genotype_combinations_per_position : list of subsets of all_genotype_combinations
@@ -21,14 +27,21 @@ class CombinedAnalysis(object):
         Subset of all_genotype_combinations that were found to match every position in the class AlignmentInfo instance
     result_alleles_dictionary : dict
         Dictionary of lists, one per detected KIR gene, storing names of result alleles from Progressive Analysis
+    cache_hit : boolean
+        Whether typing_result and result_alleles_dictionary were taken from a CombinedAnalysisCache
 
     Methods
     -------
     get_result_alleles_coding_sequences
         Gets coding sequences of alleles in a class ProgressiveAnalysis result_alleles_dictionary attribute
+    count_genotype_combinations
+        Counts all possible genotype combinations of 2 alleles per detected KIR gene
+    get_all_genotype_combinations
+        Creates all possible genotype combinations of 2 alleles per detected KIR gene
+    get_discriminant_positions
+        Calls method is_discriminant() per position to find discriminant positions and their present nucleotides
     find_matching_combinations_per_position
-        Calls methods is_discriminant() and check_genotype_combinations()
-        to find perfect matching combinations per position
+        Calls method check_genotype_combinations() to find perfect matching combinations per discriminant position
     is_discriminant
         It determines whether a position in the alignment is discriminant
     check_genotype_combinations
@@ -37,8 +50,9 @@ class CombinedAnalysis(object):
         Find all genotype combinations that match all discriminant possible and get final_result
     """
 
-    def __init__(self, progressive_analysis_instance, alignment_information_instance):
-        """Calls combined analysis methods
+    def __init__(self, progressive_analysis_instance, alignment_information_instance, cache=None):
+        """Calls combined analysis methods. When a cache is given, results of a previous sample with the same result
+        alleles and the same present nucleotides in discriminant positions are reused instead of recomputed
 
         Parameters
         ----------
@@ -46,21 +60,39 @@ class CombinedAnalysis(object):
             Instance inherited from class ProgressiveAnalysis
         alignment_information_instance : class AlignmentInfo instance
             Instance inherited from class ProgressiveAnalysis
+        cache : class CombinedAnalysisCache instance
+            Cache of combined analysis results shared between samples, None to always compute them
         """
         self.all_genotype_combinations = []
+        self.primary_combinations = 0
         self.coding_sequences_per_position = {}
         self.genotype_combinations_per_position = []
         self.typing_result = None
         self.result_alleles_dictionary = {}
+        self.cache_hit = False
 
         self.get_result_alleles_coding_sequences(progressive_analysis_instance, alignment_information_instance)
-        self.find_matching_combinations_per_position(progressive_analysis_instance, alignment_information_instance)
-        self.get_typing_results()
+        self.count_genotype_combinations(progressive_analysis_instance)
+        discriminant_positions = self.get_discriminant_positions(progressive_analysis_instance,
+                                                                 alignment_information_instance)
+        cached_results = None
+        if cache is not None:
+            cache_key = cache.get_key(progressive_analysis_instance.result_alleles_dictionary, discriminant_positions)
+            cached_results = cache.get(cache_key)
+        if cached_results is not None:
+            self.typing_result, self.result_alleles_dictionary = cached_results
+            self.cache_hit = True
+        else:
+            self.get_all_genotype_combinations(progressive_analysis_instance)
+            self.find_matching_combinations_per_position(discriminant_positions)
+            self.get_typing_results()
+            if cache is not None:
+                cache.store(cache_key, self.typing_result, self.result_alleles_dictionary)
 
     def get_result_alleles_coding_sequences(self, progressive_analysis_instance, alignment_information_instance):
         """Gets coding sequences of alleles in result_alleles_dictionary attribute from Progressive Analysis instance.
         Sequences are stored in the dictionary, as values for every allele name key.
-        Sequences are obtained from the reference file.
+        Sequences are obtained from the allele sequences stored in the reference.
 
         Parameters
         ----------
@@ -70,36 +102,41 @@ class CombinedAnalysis(object):
             Instance inherited from class AlignmentInformation
         """
 
-        with open(alignment_information_instance.reference.file_name) as alignment_reference:
-            for allele in alignment_reference.readlines()[12:-1]:   # First sequence in reference is in line 12
-                allele = allele.replace(" ", "")
-                kir_gene = allele.split("*")[0]
-                if kir_gene == "KIR2DL5A" or kir_gene == "KIR2DL5B":
-                    kir_gene = "KIR2DL5"  # KIR genes 2DL5A and 2DL5B are analyzed as a single gene locus
-
-                if kir_gene in progressive_analysis_instance.result_alleles_dictionary.keys():
-                    allele_id = allele.split("\t")[0]
-                    if allele_id in progressive_analysis_instance.result_alleles_dictionary[kir_gene]:
-                        allele_sequence = allele.split("\t")[:-4]  # Last four items in the list are \t characters
-                        allele_sequence = allele_sequence[1].replace("|", "")
-                        allele_sequence = list(allele_sequence)
-                        coding_sequence = []
-                        for position in alignment_information_instance.proportion_dictionary.keys():
-                            coding_sequence.append(allele_sequence[position])
-                        progressive_analysis_instance.result_alleles_dictionary[kir_gene][allele_id] = coding_sequence
-        alignment_reference.close()
-
-    def find_matching_combinations_per_position(self, progressive_analysis_instance, alignment_information_instance):
-        """Per position in the class AlignmentInfo instance, it finds perfect matching genotype combinations using the
-        result alleles combinations coding sequences. Calls methods is_discriminant() and check_genotype_combinations().
-        First, it creates all possible genotype combinations of 2 alleles per detected KIR gene.
+        allele_sequences = alignment_information_instance.reference.get_allele_sequences()
+        for allele_id, allele_sequence in allele_sequences.items():
+            kir_gene = allele_id.split("*")[0]
+            if kir_gene == "KIR2DL5A" or kir_gene == "KIR2DL5B":
+                kir_gene = "KIR2DL5"  # KIR genes 2DL5A and 2DL5B are analyzed as a single gene locus
+
+            if kir_gene in progressive_analysis_instance.result_alleles_dictionary.keys():
+                if allele_id in progressive_analysis_instance.result_alleles_dictionary[kir_gene]:
+                    coding_sequence = []
+                    for position in alignment_information_instance.proportion_dictionary.keys():
+                        coding_sequence.append(allele_sequence[position])
+                    progressive_analysis_instance.result_alleles_dictionary[kir_gene][allele_id] = coding_sequence
+
+    def count_genotype_combinations(self, progressive_analysis_instance):
+        """Counts all possible genotype combinations of 2 alleles per detected KIR gene, as the product over genes of
+        n(n+1)/2 for n result alleles, so they do not need to be created when results come from a cache
+
+        Parameters
+        ----------
+        progressive_analysis_instance : class ProgressiveAnalysis instance
+            Instance inherited from class ProgressiveAnalysis
+        """
+
+        self.primary_combinations = 1
+        for kir_gene in progressive_analysis_instance.result_alleles_dictionary:
+            allele_number = len(progressive_analysis_instance.result_alleles_dictionary[kir_gene])
+            self.primary_combinations *= allele_number * (allele_number + 1) // 2
+
+    def get_all_genotype_combinations(self, progressive_analysis_instance):
+        """Creates all possible genotype combinations of 2 alleles per detected KIR gene
 
         Parameters
         ----------
         progressive_analysis_instance : class ProgressiveAnalysis instance
             Instance inherited from class ProgressiveAnalysis
-        alignment_information_instance : class AlignmentInformation instance
-            Instance inherited from class AlignmentInformation
         """
 
         result_combinations_dict = {}
@@ -110,7 +147,24 @@ class CombinedAnalysis(object):
         single_gene_combinations = list(result_combinations_dict.values())
         self.all_genotype_combinations = list(it.product(*single_gene_combinations))
 
-        self.genotype_combinations_per_position = []
+    def get_discriminant_positions(self, progressive_analysis_instance, alignment_information_instance):
+        """Per position in the class AlignmentInfo instance with more than one present nucleotide, it gets the result
+        alleles coding sequences in that position and calls method is_discriminant().
+        Returns a list with the present nucleotides (excluding gaps) and coding_sequences_per_position of every
+        discriminant position. When the reference is restricted to selected genes, present nucleotides carried in a
+        position by the Progressive Analysis non_selected_alleles are left out, as reads of those genes that are not
+        typed explain them. The position is still checked for the remaining present nucleotides
+
+        Parameters
+        ----------
+        progressive_analysis_instance : class ProgressiveAnalysis instance
+            Instance inherited from class ProgressiveAnalysis
+        alignment_information_instance : class AlignmentInformation instance
+            Instance inherited from class AlignmentInformation
+        """
+
+        allele_sequences = alignment_information_instance.reference.get_allele_sequences()
+        discriminant_positions = []
         for coding_position, alignment_position in enumerate(alignment_information_instance.proportion_dictionary):
             present_nucleotides = []
             for nucleotide in \
@@ -125,7 +179,28 @@ class CombinedAnalysis(object):
                         self.coding_sequences_per_position[kir_gene][allele] = \
                             progressive_analysis_instance.result_alleles_dictionary[kir_gene][allele][coding_position]
                 if self.is_discriminant() is True:
-                    self.check_genotype_combinations(present_nucleotides)
+                    non_selected_nucleotides = [allele_sequences[allele][alignment_position]
+                                                for allele in progressive_analysis_instance.non_selected_alleles]
+                    present_nucleotides = [nucleotide for nucleotide in present_nucleotides
+                                           if nucleotide not in non_selected_nucleotides]
+                    discriminant_positions.append((present_nucleotides, self.coding_sequences_per_position))
+        return discriminant_positions
+
+    def find_matching_combinations_per_position(self, discriminant_positions):
+        """Per discriminant position in the class AlignmentInfo instance, it finds perfect matching genotype
+        combinations using the result alleles combinations coding sequences. Calls method check_genotype_combinations().
+
+        Parameters
+        ----------
+        discriminant_positions : list
+            Present nucleotides and coding_sequences_per_position per discriminant position, as returned by
+            get_discriminant_positions()
+        """
+
+        self.genotype_combinations_per_position = []
+        for present_nucleotides, coding_sequences_per_position in discriminant_positions:
+            self.coding_sequences_per_position = coding_sequences_per_position
+            self.check_genotype_combinations(present_nucleotides)
 
     def is_discriminant(self):
         """It determines whether a position in the alignment is discriminant. This depends on the number of present
@@ -197,3 +272,198 @@ class CombinedAnalysis(object):
                 if kir_gene not in self.result_alleles_dictionary:
                     self.result_alleles_dictionary[kir_gene] = []
                 self.result_alleles_dictionary[kir_gene].append(allele)
+
+
+class CombinedAnalysisCache(object):
+    """This class stores combined analysis results so they can be reused by samples of a cohort that share the same
+    result alleles from Progressive Analysis and the same present nucleotides in discriminant positions.
+    Results are kept in memory with least recently used eviction, and optionally in a directory on disk as JSON files
+    so they are shared between runs and processes. Files that cannot be decoded are treated as missing. The number of
+    files on disk can be bounded as well, evicting the least recently used files first
+    ...
+
+    Attributes
+    ----------
+    max_size : int
+        Maximum number of results kept in memory
+    cache_directory : str
+        Path of the directory where results are stored on disk, None to keep them in memory only
+    max_files : int
+        Maximum number of results stored on disk, None for no limit
+    results_dictionary : OrderedDict
+        Results kept in memory by cache key, from least to most recently used, in the form stored in JSON files
+    hits : int
+        Number of results found in the cache
+    misses : int
+        Number of results not found in the cache
+
+    Methods
+    -------
+    get_key
+        Creates a cache key out of result alleles and discriminant positions information
+    get
+        Returns the results stored for a cache key, or None
+    store
+        Stores the results of a cache key in memory and on disk
+    add_to_memory
+        Keeps results in memory, evicting the least recently used ones
+    remove_old_files
+        Removes the least recently used files on disk above max_files
+    decode_results
+        Converts stored results back into typing_result and result_alleles_dictionary
+    """
+
+    def __init__(self, max_size=128, cache_directory=None, max_files=None):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of results kept in memory
+        cache_directory : str
+            Path of the directory where results are stored on disk, None to keep them in memory only
+        max_files : int
+            Maximum number of results stored on disk, None for no limit
+        """
+
+        self.max_size = max_size
+        self.cache_directory = cache_directory
+        self.max_files = max_files
+        self.results_dictionary = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_directory is not None:
+            os.makedirs(self.cache_directory, exist_ok=True)
+
+    def get_key(self, result_alleles_dictionary, discriminant_positions):
+        """Creates a content-addressed cache key, a hash of the result alleles per KIR gene and, per discriminant
+        position, the present nucleotides and the nucleotide of every result allele
+
+        Parameters
+        ----------
+        result_alleles_dictionary : dict
+            Class ProgressiveAnalysis result_alleles_dictionary attribute
+        discriminant_positions : list
+            As returned by class CombinedAnalysis method get_discriminant_positions()
+        """
+
+        key_content = [tuple((kir_gene, tuple(result_alleles_dictionary[kir_gene].keys()))
+                             for kir_gene in result_alleles_dictionary)]
+        for present_nucleotides, coding_sequences_per_position in discriminant_positions:
+            key_content.append((tuple(sorted(present_nucleotides)),
+                                tuple(tuple(coding_sequences_per_position[kir_gene].values())
+                                      for kir_gene in coding_sequences_per_position)))
+        return hashlib.sha256(repr(key_content).encode()).hexdigest()
+
+    def get(self, cache_key):
+        """Returns the typing_result and result_alleles_dictionary stored for a cache key, looking first in memory and
+        then on disk. Returns None if they are not found, or if their file cannot be read or decoded
+
+        Parameters
+        ----------
+        cache_key : str
+            Key created by method get_key()
+        """
+
+        decoded_results = None
+        if cache_key in self.results_dictionary:
+            self.results_dictionary.move_to_end(cache_key)
+            decoded_results = self.decode_results(self.results_dictionary[cache_key])
+        elif self.cache_directory is not None:
+            cache_file_name = os.path.join(self.cache_directory, cache_key + ".json")
+            if os.path.exists(cache_file_name):
+                try:
+                    with open(cache_file_name) as cache_file:
+                        cached_results = json.load(cache_file)
+                    cache_file.close()
+                    decoded_results = self.decode_results(cached_results)
+                    self.add_to_memory(cache_key, cached_results)
+                except (OSError, ValueError, KeyError, TypeError):  # Truncated or corrupt file, results are recomputed
+                    decoded_results = None
+                if decoded_results is not None and self.max_files is not None:
+                    try:
+                        os.utime(cache_file_name)  # Modification time orders files from least to most recently used
+                    except OSError:
+                        pass
+        if decoded_results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decoded_results
+
+    def store(self, cache_key, typing_result, result_alleles_dictionary):
+        """Stores a copy of typing_result and result_alleles_dictionary for a cache key, in memory and on disk
+
+        Parameters
+        ----------
+        cache_key : str
+            Key created by method get_key()
+        typing_result : list/set
+            Class CombinedAnalysis typing_result attribute
+        result_alleles_dictionary : dict
+            Class CombinedAnalysis result_alleles_dictionary attribute
+        """
+
+        cached_results = {"typing_result": None, "result_alleles_dictionary": {}}
+        if typing_result is not None:
+            cached_results["typing_result"] = [[[str(allele) for allele in genotype] for genotype in combination]
+                                               for combination in typing_result]
+        for kir_gene in result_alleles_dictionary:
+            cached_results["result_alleles_dictionary"][kir_gene] = [str(allele) for allele in
+                                                                     result_alleles_dictionary[kir_gene]]
+        self.add_to_memory(cache_key, cached_results)
+        if self.cache_directory is not None:
+            cache_file_name = os.path.join(self.cache_directory, cache_key + ".json")
+            temporary_file_name = "%s.%i.tmp" % (cache_file_name, os.getpid())
+            with open(temporary_file_name, 'w') as cache_file:
+                json.dump(cached_results, cache_file)
+            cache_file.close()
+            os.replace(temporary_file_name, cache_file_name)  # Other processes never read a partially written file
+            if self.max_files is not None:
+                self.remove_old_files()
+
+    def add_to_memory(self, cache_key, cached_results):
+        """Keeps results in memory, evicting the least recently used ones above max_size"""
+
+        self.results_dictionary[cache_key] = cached_results
+        self.results_dictionary.move_to_end(cache_key)
+        while len(self.results_dictionary) > self.max_size:
+            self.results_dictionary.popitem(last=False)
+
+    def remove_old_files(self):
+        """Removes the files with the oldest modification times from cache_directory while there are more than
+        max_files. Files already removed by another process are skipped
+        """
+
+        cache_files = []
+        for file_name in os.listdir(self.cache_directory):
+            if file_name.endswith(".json"):
+                try:
+                    cache_file_name = os.path.join(self.cache_directory, file_name)
+                    cache_files.append((os.path.getmtime(cache_file_name), cache_file_name))
+                except FileNotFoundError:
+                    pass
+        cache_files.sort()
+        for modification_time, cache_file_name in cache_files[:max(0, len(cache_files) - self.max_files)]:
+            try:
+                os.remove(cache_file_name)
+            except FileNotFoundError:
+                pass
+
+    def decode_results(self, cached_results):
+        """Converts results in the form stored in JSON files back into a typing_result list of tuples and a
+        result_alleles_dictionary of lists. Raises KeyError or TypeError if they do not have that form
+
+        Parameters
+        ----------
+        cached_results : dict
+            Results as created by method store()
+        """
+
+        typing_result = None
+        if cached_results["typing_result"] is not None:
+            typing_result = [tuple(tuple(genotype) for genotype in combination)
+                             for combination in cached_results["typing_result"]]
+        result_alleles_dictionary = {}
+        for kir_gene in cached_results["result_alleles_dictionary"]:
+            result_alleles_dictionary[kir_gene] = list(cached_results["result_alleles_dictionary"][kir_gene])
+        return typing_result, result_alleles_dictionary
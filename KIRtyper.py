@@ -1,5 +1,7 @@
-from sys import argv
+import argparse
 import gzip
+import io
+import sys
 from Reference import *
 from Read import *
 from AlignmentInformation import *
@@ -8,47 +10,189 @@ from CombinedAnalysis import *
 
 """
 Main module of KIR Typer bioinformatics pipeline. It performs typing of human KIR genes. Input is an alignment in
-SAM format, and a reference file. This reference file (KIR_full.ipd) was previously used to align DNA reads from NGS
-with NGSengine. Typing results are written into indicated output text file. 
+SAM format (plain or gzipped, from a file, a named pipe or stdin), and a reference file. This reference file
+(KIR_full.ipd) was previously used to align DNA reads from NGS with NGSengine. Typing results are written into
+indicated output text file. 
 
 Required libraries and packages: gzip, pandas, itertools, numpy
 
 Use: 
     Command line: python3 KIRtyper.py [reference.ipd] [samfile.sam] [output.txt]
+    Targeted typing: python3 KIRtyper.py [reference.ipd] [samfile.sam] [output.txt]
+                     --genes KIR2DL1 KIR3DL1 --exons 1 2
+    High duplication libraries: python3 KIRtyper.py [reference.ipd] [samfile.sam] [output.txt] --collapse-duplicates
+    Cohorts: python3 KIRtyper.py [reference.ipd] [samfile.sam] [output.txt] --cache-dir [cache_directory]
+             (every run types one sample, so the command line cache is kept on disk only, with no size limit)
+    Streaming from an aligner: [aligner command] | python3 KIRtyper.py [reference.ipd] - [output.txt]
+                               --sample-name [sample_name]
+    Resident typing server: see TypingServer.py
 """
 
 
 def main():
-    reference = Reference(argv[1])
-    reference.get_regions_index()
-    print("Reference %s processed" % argv[1])
-    with gzip.open(argv[2], 'rt') as sam_file:
-        alignment = AlignmentInformation(reference)
+    parser = argparse.ArgumentParser(description="Typing of human KIR genes from a SAM alignment")
+    parser.add_argument("reference_file", help="Reference file (KIR_full.ipd) used for the alignment")
+    parser.add_argument("sam_file", help="SAM file with the aligned reads, plain or gzipped. "
+                                         "It can be a named pipe, or - to read from stdin")
+    parser.add_argument("output_file", help="Text file to which typing results are appended")
+    parser.add_argument("--sample-name", default=None,
+                        help="Name of the sample in the output file, the SAM file name by default. "
+                             "Useful to tell apart results of samples read from stdin")
+    add_typing_arguments(parser)
+    arguments = parser.parse_args()
+
+    try:
+        reference = load_reference(arguments.reference_file, arguments.genes, arguments.exons)
+    except ValueError as error:
+        parser.error(str(error))
+    print("Reference %s processed" % arguments.reference_file)
+    with open_sam_file(arguments.sam_file) as sam_file:
         print("Processing alignment information in SAM file...")
-        for line in sam_file.readlines()[2:]:  # Information of reads alignment starts in 2nd line
-            read = Read(line)
-            if read.flag != 4 and read.quality == 255:
-                '''
-                Reads with flag value 4 (i.e. not aligned) and quality value different than 255 (optimal) 
-                are not processed
-                '''
-                read.parse_cigar()
-                read.get_aligned_sequence()
-                for exon_range in reference.exons_index_list:
-                    in_exons = read.is_aligned_to(exon_range)
-                    if in_exons is True:  # Only exon information is accounted
-                        alignment.update_count_dictionary(read)
-                        break
-        alignment.create_proportion_dictionary()
-        print("Progressive analysis in progress...")
-        progressive_analysis = ProgressiveAnalysis(alignment)  # Proportion_threshold value customizable, default=5
-        print("%i genes/s detected" % len(list(progressive_analysis.result_alleles_dictionary.keys())))
-        print("Combined analysis in progress...")
-        combined_analysis = CombinedAnalysis(progressive_analysis, alignment)
-        write_output_file(progressive_analysis, combined_analysis, argv[2], argv[3])
-        print("Analysis done, results written into output file: %s" % argv[3])
-        sam_file.close()
+        alignment = process_alignment(reference, sam_file, arguments.collapse_duplicates)
     sam_file.close()
+    print("Progressive analysis in progress...")
+    progressive_analysis = ProgressiveAnalysis(alignment)  # Proportion_threshold value customizable, default=5
+    print("%i genes/s detected" % len(list(progressive_analysis.result_alleles_dictionary.keys())))
+    print("Combined analysis in progress...")
+    combined_analysis_cache = None
+    if arguments.cache_dir is not None:
+        combined_analysis_cache = CombinedAnalysisCache(0, arguments.cache_dir)  # Disk only, one sample per run
+    combined_analysis = CombinedAnalysis(progressive_analysis, alignment, combined_analysis_cache)
+    if combined_analysis_cache is not None:
+        if combined_analysis.cache_hit is True:
+            print("Combined analysis results reused from cache %s" % arguments.cache_dir)
+        else:
+            print("Combined analysis results stored in cache %s" % arguments.cache_dir)
+    sample_name = arguments.sam_file if arguments.sample_name is None else arguments.sample_name
+    write_output_file(progressive_analysis, combined_analysis, sample_name, arguments.output_file)
+    print("Analysis done, results written into output file: %s" % arguments.output_file)
+
+
+def add_typing_arguments(parser):
+    """Adds the optional gene and exon subset, duplicate collapsing and combined analysis cache directory arguments
+    to a command line argument parser
+    """
+
+    parser.add_argument("--genes", nargs="+", default=None,
+                        help="Type only these KIR genes (e.g. KIR2DL1 KIR2DL3), all genes by default")
+    parser.add_argument("--exons", nargs="+", type=int, default=None,
+                        help="Type only these exon numbers, starting from exon 1, all exons by default")
+    parser.add_argument("--collapse-duplicates", action="store_true",
+                        help="Decode reads with identical position, cigar and sequence once, counting them by weight. "
+                             "Pileup is then updated at the end of the input, not as reads arrive")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory where combined analysis results are cached on disk, to be reused by samples "
+                             "with the same result alleles and discriminant positions")
+
+
+def open_sam_file(sam_file_name):
+    """Opens a SAM file as a text stream that is read line by line, so reads are processed as they arrive from
+    a named pipe or stdin. Gzip compression is detected from the magic bytes at the start of the stream
+
+    Parameters
+    ----------
+    sam_file_name : str
+        Path of a plain or gzipped SAM file or named pipe, or - to read from stdin
+    """
+
+    if sam_file_name == "-":
+        sam_stream = sys.stdin.buffer
+    else:
+        sam_stream = open(sam_file_name, 'rb')
+    magic_bytes = b""
+    while len(magic_bytes) < 2:  # A pipe can deliver a single byte at a time
+        stream_bytes = sam_stream.read1(2 - len(magic_bytes))
+        if stream_bytes == b"":  # End of stream
+            break
+        magic_bytes += stream_bytes
+    sam_stream = io.BufferedReader(PrefixedStream(magic_bytes, sam_stream))
+    if magic_bytes == b"\x1f\x8b":  # Gzip magic bytes
+        sam_stream = gzip.GzipFile(fileobj=sam_stream)
+    return io.TextIOWrapper(sam_stream)
+
+
+class PrefixedStream(io.RawIOBase):
+    """Binary stream that returns bytes already read from another stream, before the rest of that stream.
+    Used by open_sam_file to give back the magic bytes read from a pipe, which cannot be rewound
+    """
+
+    def __init__(self, prefix_bytes, stream):
+        """
+        Parameters
+        ----------
+        prefix_bytes : bytes
+            Bytes already read from stream
+        stream : binary stream
+            Stream to be read after prefix_bytes
+        """
+
+        self.prefix_bytes = prefix_bytes
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self.prefix_bytes) > 0:
+            stream_bytes = self.prefix_bytes[:len(buffer)]
+            self.prefix_bytes = self.prefix_bytes[len(stream_bytes):]
+        else:
+            stream_bytes = self.stream.read1(len(buffer))
+        buffer[:len(stream_bytes)] = stream_bytes
+        return len(stream_bytes)
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+def load_reference(reference_file, kir_genes=None, exons=None):
+    """Creates a class Reference instance with its regions indexes and allele sequences already processed,
+    restricted to the selected KIR genes and exons when given
+    """
+
+    reference = Reference(reference_file)
+    reference.get_regions_index()
+    reference.get_allele_sequences()
+    reference.select_subset(kir_genes, exons)
+    return reference
+
+
+def process_alignment(reference, sam_lines, collapse_duplicates=False):
+    """Creates an AlignmentInformation instance out of an iterable of SAM lines (an open SAM file or a list of lines)
+    and a processed class Reference instance. Returns the instance with its proportion_dictionary already created.
+    When collapse_duplicates is True, reads with identical alignments are decoded once and counted by weight.
+    count_dictionary is then only updated once the last SAM line is read, so typing no longer overlaps with an aligner
+    streaming into a pipe or stdin; only cigar decoding of new alignments happens as reads arrive.
+    Header lines (starting with @) and blank lines are skipped, whatever their number. Earlier versions skipped
+    exactly the first two lines of the SAM file, so files with a different number of header lines are now counted
+    differently
+    """
+
+    alignment = AlignmentInformation(reference)
+    for line in sam_lines:
+        if line.startswith("@") or line.strip() == "":  # Header lines hold no read alignment information
+            continue
+        read = Read(line)
+        if read.flag != 4 and read.quality == 255:
+            '''
+            Reads with flag value 4 (i.e. not aligned) and quality value different than 255 (optimal) 
+            are not processed
+            '''
+            if collapse_duplicates is True:
+                alignment.collapse_read(read)
+                continue
+            read.parse_cigar()
+            read.get_aligned_sequence()
+            for exon_range in reference.exons_index_list:
+                in_exons = read.is_aligned_to(exon_range)
+                if in_exons is True:  # Only exon information is accounted
+                    alignment.update_count_dictionary(read)
+                    break
+    if collapse_duplicates is True:
+        alignment.update_collapsed_reads()
+    alignment.create_proportion_dictionary()
+    return alignment
 
 
 def write_output_file(progressive_analysis_instance, combined_analysis_instance, sam_file, output_file_name):
@@ -68,7 +212,7 @@ def write_output_file(progressive_analysis_instance, combined_analysis_instance,
                 output_file.write(
                     "%i Genotype combinations matching alignment data, out of %i primary combinations\n" % (
                     len(list(combined_analysis_instance.typing_result)),
-                    len(combined_analysis_instance.all_genotype_combinations)))
+                    combined_analysis_instance.primary_combinations))
                 for item in list(combined_analysis_instance.typing_result):
                     output_file.write('+'.join(str(genotype) for genotype in item))
                     output_file.write("-")
@@ -81,7 +225,7 @@ def write_output_file(progressive_analysis_instance, combined_analysis_instance,
             else:
                 output_file.write("No genotype combination matches alignment information, "
                                   "out of %i primary combinations\n"
-                                  % len(combined_analysis_instance.all_genotype_combinations))
+                                  % combined_analysis_instance.primary_combinations)
     output_file.close()
     return "Output written"
 
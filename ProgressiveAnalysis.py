@@ -11,6 +11,9 @@ class ProgressiveAnalysis(object):
         Dictionary of lists, one per detected KIR gene, storing names of result alleles from Progressive Analysis
     exon_identical_alleles : dict
         Dictionary of lists per KIR gene, storing names of exon identical alleles to those in result_alleles_dictionary
+    non_selected_alleles : list
+        Names of result alleles from KIR genes that were not selected for typing in the Reference instance. They are
+        not typed, but Combined Analysis uses them to account for reads of those genes
 
     Methods
     -------
@@ -24,7 +27,7 @@ class ProgressiveAnalysis(object):
     def __init__(self, alignment_information_instance, proportion_threshold=5):
         """Iterates over the class AlignmentInformation proportion_dictionary instance positions.
         Determines present nucleotides per position based on proportion_threshold parameter, add them to dictionary.
-        Per position, iterates over class AlignmentInformation reference_file,
+        Per position, iterates over the allele sequences of the class AlignmentInformation reference,
         discards alleles that do not contain any of the present nucleotides (excluding gaps) in the same index position.
         Discarded alleles are excluded from the reference_alleles list and not considered in further positions
 
@@ -38,6 +41,8 @@ class ProgressiveAnalysis(object):
 
         self.result_alleles_dictionary = {}
         self.exon_identical_alleles = {}
+        self.non_selected_alleles = []
+        allele_sequences = alignment_information_instance.reference.get_allele_sequences()
         for position in alignment_information_instance.proportion_dictionary:
             present_nucleotides = []
             for nucleotide in alignment_information_instance.proportion_dictionary[position]:
@@ -45,18 +50,14 @@ class ProgressiveAnalysis(object):
                     present_nucleotides.append(nucleotide)
             alignment_information_instance.proportion_dictionary[position]["Present Nucleotides"] = present_nucleotides
             primary_result_alleles = alignment_information_instance.reference_alleles
-            with open(alignment_information_instance.reference.file_name) as alignment_reference:
-                for allele in alignment_reference.readlines()[12:-1]:  # First sequence in reference is in line 12
-                    allele = allele.replace(" ", "")
-                    allele_id = allele.split("\t")[0]
-                    if allele_id in primary_result_alleles:
-                        allele_sequence = allele.split("\t")[:-4]  # Last four items in the list are \t characters
-                        allele_sequence = allele_sequence[1].replace("|", "")
-                        allele_sequence = list(allele_sequence)
-                        if allele_sequence[position] not in present_nucleotides:
-                            primary_result_alleles.remove(allele_id)
-            alignment_reference.close()
-        self.process_result_alleles(primary_result_alleles)
+            for allele_id in list(primary_result_alleles):
+                if allele_sequences[allele_id][position] not in present_nucleotides:
+                    primary_result_alleles.remove(allele_id)
+        reference = alignment_information_instance.reference
+        self.non_selected_alleles = [allele for allele in primary_result_alleles
+                                     if reference.is_selected_allele(allele) is False]
+        self.process_result_alleles([allele for allele in primary_result_alleles
+                                     if reference.is_selected_allele(allele) is True])
 
     def process_result_alleles(self, primary_result_alleles):
         """Reads list of result alleles from progressive analysis, separate them into their specific KIR genes.
@@ -18,12 +18,24 @@ class Reference(object):
         Contains tuples corresponding to the range of positions within every intron region is comprised
     exons_index_list : list
         Contains tuples corresponding to the range of positions within every intron region is comprised
+    allele_sequences : dict
+        Allele names in the reference as keys, with their full aligned sequences (region separators removed) as values.
+        Filled once by get_allele_sequences, so the reference file is not parsed again by every analysis step
+    selected_genes : list
+        KIR genes selected by select_subset, None when every gene in the reference is typed. Alleles of other genes
+        stay in allele_sequences, so Progressive Analysis still accounts for the reads those genes add to the alignment
 
     Methods
     -------
     get_regions_index
         Extracts regions_index_list from first_sequence
         Creates exons_index_list and introns_index_list out of regions_index_list
+    get_allele_sequences
+        Reads every allele sequence in the reference file once and returns allele_sequences
+    select_subset
+        Restricts exons_index_list to selected exons and typing results to selected KIR genes, for targeted typing
+    is_selected_allele
+        Returns whether an allele belongs to the KIR genes selected for typing
     print_sequence
         Prints sequence between two given nucleotide positions, of the first allele in the selected KIR gene
         from the reference
@@ -47,6 +59,8 @@ class Reference(object):
         self.regions_index_list = [0]  # First region starts in position 0
         self.introns_index_list = []
         self.exons_index_list = []
+        self.allele_sequences = {}
+        self.selected_genes = None
 
     def get_regions_index(self):
         """Extracts regions_index_list from first_sequence
@@ -65,6 +79,81 @@ class Reference(object):
                 exon_index = (self.regions_index_list[i], self.regions_index_list[i + 1])
                 self.exons_index_list.append(exon_index)
 
+    def get_allele_sequences(self):
+        """Reads every allele sequence in the reference file and stores it in allele_sequences, keyed by allele name.
+        The reference file is only read the first time; later calls return the stored dictionary
+        """
+
+        if self.allele_sequences == {}:
+            with open(self.file_name) as alignment_reference:
+                for allele in alignment_reference.readlines()[12:-1]:  # First sequence in reference starts in line 12
+                    allele = allele.replace(" ", "")
+                    allele_id = allele.split("\t")[0]
+                    allele_sequence = allele.split("\t")[:-4]  # Last four items in the list are \t characters
+                    self.allele_sequences[allele_id] = allele_sequence[1].replace("|", "")
+            alignment_reference.close()
+        return self.allele_sequences
+
+    def select_subset(self, kir_genes=None, exons=None):
+        """Restricts the reference to selected KIR genes and/or exons. Exons that were not selected are removed from
+        exons_index_list, so count_dictionary and every further analysis only cover the selected exons.
+        Selected genes are stored in selected_genes. Alleles of other genes are kept, because reads from those genes
+        can still be in the alignment: Progressive Analysis runs over every gene, then only alleles of selected genes
+        are candidate alleles and form genotype combinations. Combined Analysis treats nucleotides carried by the
+        remaining alleles of other genes as covered by them. Must be called after get_regions_index
+
+        Parameters
+        ----------
+        kir_genes : list
+            Names of the KIR genes to be typed (e.g. KIR2DL1). KIR2DL5 selects both KIR2DL5A and KIR2DL5B.
+            None keeps every gene
+        exons : list
+            Numbers of the exons to be typed, starting from exon 1. None keeps every exon
+
+        Raises
+        ------
+        ValueError
+            If a selected KIR gene or exon is not found in the reference
+        """
+
+        if exons is not None:
+            for exon in exons:
+                if exon < 1 or exon > len(self.exons_index_list):
+                    raise ValueError("Exon %i not found in reference, exons 1 to %i available"
+                                     % (exon, len(self.exons_index_list)))
+            self.exons_index_list = [exon_range for exon_index, exon_range in enumerate(self.exons_index_list)
+                                     if exon_index + 1 in exons]
+
+        if kir_genes is not None:
+            found_genes = set()
+            for allele_id in self.get_allele_sequences():
+                allele_gene = allele_id.split("*")[0]
+                kir_gene = allele_gene
+                if kir_gene == "KIR2DL5A" or kir_gene == "KIR2DL5B":
+                    kir_gene = "KIR2DL5"  # KIR genes 2DL5A and 2DL5B are analyzed as a single gene locus
+                found_genes.update((allele_gene, kir_gene))
+            for kir_gene in kir_genes:
+                if kir_gene not in found_genes:
+                    raise ValueError("KIR gene %s not found in reference" % kir_gene)
+            self.selected_genes = list(kir_genes)
+
+    def is_selected_allele(self, allele_id):
+        """Returns True if the allele belongs to one of the selected_genes, or if no genes were selected
+
+        Parameters
+        ----------
+        allele_id : str
+            Name of an allele in the reference (e.g. KIR2DL1*001)
+        """
+
+        if self.selected_genes is None:
+            return True
+        allele_gene = allele_id.split("*")[0]
+        kir_gene = allele_gene
+        if kir_gene == "KIR2DL5A" or kir_gene == "KIR2DL5B":
+            kir_gene = "KIR2DL5"  # KIR genes 2DL5A and 2DL5B are analyzed as a single gene locus
+        return allele_gene in self.selected_genes or kir_gene in self.selected_genes
+
     def print_sequence(self, leftmost_position, rightmost_position, kir_gene):
         """Prints sequence between two given nucleotide positions of the first allele in the selected KIR gene of the
         reference
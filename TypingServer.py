@@ -0,0 +1,363 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from KIRtyper import *
+
+"""
+Resident typing server of KIR Typer bioinformatics pipeline. The reference file (KIR_full.ipd) is loaded once, when the
+server starts, and every worker process of the pool keeps it in memory. Samples are then typed one by one through
+HTTP requests, without paying again for Python start-up, module imports or reference parsing.
+
+Endpoints:
+    POST /type      Types a single sample. The request body is either a JSON object {"sam_file": "path/to/file.sam.gz"}
+                    (Content-Type: application/json) with the path of a plain or gzipped SAM file, or the SAM body
+                    itself (any other Content-Type), plain or gzipped. Gzipped bodies are recognized by their magic
+                    bytes and decompressed. SAM bodies can be sent with a Content-Length or streamed with
+                    Transfer-Encoding: chunked. PUT is accepted as well. Structured typing results are returned as
+                    JSON. Empty or unparseable SAM input and missing files are answered with a 400 status
+    GET /metrics    Returns queue depth (samples waiting for a worker), running and processed samples, latency and
+                    combined analysis cache metrics as JSON
+
+Combined analysis results are cached, so samples of a cohort with the same result alleles and discriminant positions
+reuse them whichever worker types them. Workers share the cache through a directory on disk (--cache-dir, or a
+temporary directory removed when the server stops), and every worker keeps its most recent results in memory
+(--cache-size). The directory keeps at most --cache-files results, removing the least recently used ones first.
+The cache is disabled with --cache-size 0 and no --cache-dir; cache metrics are then null.
+
+Required libraries and packages: gzip, pandas, itertools, numpy
+
+Use:
+    Command line: python3 TypingServer.py [reference.ipd] [--port PORT] [--workers WORKERS]
+                  [--genes KIR2DL1 KIR3DL1] [--exons 3 4 5] [--collapse-duplicates]
+                  [--cache-size CACHE_SIZE] [--cache-files CACHE_FILES] [--cache-dir CACHE_DIR]
+    Typing request: curl -H "Content-Type: application/json" -d '{"sam_file": "sample.sam.gz"}' localhost:[port]/type
+                    curl --data-binary @sample.sam localhost:[port]/type
+                    curl -T sample.sam.gz localhost:[port]/type
+                    [aligner command] | curl -T - localhost:[port]/type
+"""
+
+worker_reference = None  # Reference instance kept in memory by every worker process
+worker_cache = None  # CombinedAnalysisCache instance of every worker process
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident KIR typing server")
+    parser.add_argument("reference_file", help="Reference file (KIR_full.ipd) used for the alignments")
+    parser.add_argument("--port", type=int, default=8000, help="Local port the server listens on")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes, the number of processors by default")
+    parser.add_argument("--cache-size", type=int, default=128,
+                        help="Maximum number of combined analysis results cached in memory by every worker")
+    parser.add_argument("--cache-files", type=int, default=10000,
+                        help="Maximum number of combined analysis results cached on disk, shared by all workers")
+    add_typing_arguments(parser)
+    arguments = parser.parse_args()
+
+    try:
+        reference = load_reference(arguments.reference_file, arguments.genes, arguments.exons)
+    except ValueError as error:
+        parser.error(str(error))
+    print("Reference %s processed" % arguments.reference_file)
+    cache_enabled = arguments.cache_size > 0 or arguments.cache_dir is not None
+    cache_directory = arguments.cache_dir
+    if cache_enabled is True and cache_directory is None:
+        cache_directory = tempfile.mkdtemp(prefix="kirtyper_cache_")  # Shared by all workers while the server runs
+    workers = arguments.workers if arguments.workers is not None else os.cpu_count()
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))  # Stops as cleanly as KeyboardInterrupt
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initialize_worker,
+                                 initargs=(reference, cache_enabled, arguments.cache_size,
+                                           cache_directory, arguments.cache_files)) as executor:
+            server = ThreadingHTTPServer(("127.0.0.1", arguments.port), TypingRequestHandler)
+            server.executor = executor
+            server.metrics = ServerMetrics(workers, cache_enabled)
+            server.collapse_duplicates = arguments.collapse_duplicates
+            print("Typing server listening on port %i" % arguments.port)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            server.server_close()
+    finally:
+        if arguments.cache_dir is None and cache_directory is not None:
+            shutil.rmtree(cache_directory, ignore_errors=True)
+
+
+def initialize_worker(reference, cache_enabled=True, cache_size=128, cache_directory=None, cache_files=None):
+    """Stores the processed class Reference instance in the worker process, so it is only loaded once per worker.
+    Creates the combined analysis cache of the worker, backed by the cache directory shared by all workers
+    """
+
+    global worker_reference, worker_cache
+    worker_reference = reference
+    if cache_enabled is True:
+        worker_cache = CombinedAnalysisCache(cache_size, cache_directory, cache_files)
+
+
+def type_sample(sam_file_name=None, sam_body=None, collapse_duplicates=False):
+    """Runs the typing pipeline in a worker process, over a plain or gzipped SAM file or over a SAM body given as a
+    string. Returns the structured typing results
+
+    Parameters
+    ----------
+    sam_file_name : str
+        Path of a plain or gzipped SAM file, or of a named pipe
+    sam_body : str
+        Full content of a SAM file
+    collapse_duplicates : bool
+        Whether reads with identical alignments are decoded once and counted by weight
+
+    Raises
+    ------
+    ValueError
+        If the SAM input cannot be parsed, or it has no aligned reads covering the exon positions
+    """
+
+    try:
+        if sam_file_name is not None:
+            with open_sam_file(sam_file_name) as sam_file:
+                alignment = process_alignment(worker_reference, sam_file, collapse_duplicates)
+            sam_file.close()
+        else:
+            alignment = process_alignment(worker_reference, sam_body.splitlines(), collapse_duplicates)
+    except (IndexError, ValueError) as error:
+        raise ValueError("SAM input could not be parsed (%s: %s)" % (type(error).__name__, error))
+    except ZeroDivisionError:
+        raise ValueError("SAM input has no aligned reads covering every exon position")
+    progressive_analysis = ProgressiveAnalysis(alignment)
+    combined_analysis = CombinedAnalysis(progressive_analysis, alignment, worker_cache)
+    typing_results = get_typing_results_dictionary(progressive_analysis, combined_analysis)
+    if worker_cache is None:
+        typing_results["combined_analysis_cache_hit"] = None
+    return typing_results
+
+
+def get_typing_results_dictionary(progressive_analysis_instance, combined_analysis_instance):
+    """Gathers the results written by write_output_file into a JSON serializable dictionary"""
+
+    typing_results = {
+        "detected_genes": list(progressive_analysis_instance.result_alleles_dictionary.keys()),
+        "progressive_result_alleles": {},
+        "combined_analysis_applicable": combined_analysis_instance.typing_result is not None,
+        "primary_combinations": combined_analysis_instance.primary_combinations,
+        "genotype_combinations": [],
+        "combined_result_alleles": {},
+        "combined_analysis_cache_hit": combined_analysis_instance.cache_hit
+    }
+    for locus in progressive_analysis_instance.result_alleles_dictionary:
+        typing_results["progressive_result_alleles"][locus] = list(
+            progressive_analysis_instance.result_alleles_dictionary[locus].keys())
+    if combined_analysis_instance.typing_result is not None:
+        for combination in combined_analysis_instance.typing_result:
+            typing_results["genotype_combinations"].append([list(genotype) for genotype in combination])
+        for locus in combined_analysis_instance.result_alleles_dictionary:
+            typing_results["combined_result_alleles"][locus] = [
+                str(allele) for allele in combined_analysis_instance.result_alleles_dictionary[locus]]
+    return typing_results
+
+
+class ServerMetrics(object):
+    """This class keeps track of the typing requests handled by the server. It is shared by all request threads.
+    Latencies are kept as running totals plus a bounded window of recent values, so memory does not grow with the
+    number of samples the server types
+    ...
+
+    Attributes
+    ----------
+    workers : int
+        Number of worker processes, that is, samples that can be typed at the same time
+    samples_in_progress : int
+        Samples submitted to the worker pool that are not finished yet, running or waiting for a worker
+    processed_samples : int
+        Samples whose typing finished successfully
+    failed_samples : int
+        Samples whose typing raised an error
+    cache_enabled : bool
+        Whether combined analysis results are cached, cache counters are None otherwise
+    cache_hits : int
+        Processed samples whose combined analysis results were found in the cache
+    cache_misses : int
+        Processed samples whose combined analysis results were computed and cached
+    latency_sum : float
+        Sum of the latencies, in seconds from submission to result, of every processed sample
+    latency_max : float
+        Highest latency of a processed sample
+    recent_latencies : deque
+        Latencies of the most recently processed samples, at most recent_latencies_size of them
+
+    Methods
+    -------
+    sample_submitted
+        Accounts a new sample in progress
+    sample_finished
+        Accounts a sample as finished and stores its latency and combined analysis cache outcome
+    get_metrics_dictionary
+        Returns queue depth, running samples and latency metrics as a dictionary
+    """
+
+    def __init__(self, workers, cache_enabled=True, recent_latencies_size=100):
+        self.workers = workers
+        self.samples_in_progress = 0
+        self.processed_samples = 0
+        self.failed_samples = 0
+        self.cache_enabled = cache_enabled
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.recent_latencies = deque(maxlen=recent_latencies_size)
+        self.lock = threading.Lock()
+
+    def sample_submitted(self):
+        with self.lock:
+            self.samples_in_progress += 1
+
+    def sample_finished(self, latency, failed=False, cache_hit=None):
+        with self.lock:
+            self.samples_in_progress -= 1
+            if failed is True:
+                self.failed_samples += 1
+            else:
+                self.processed_samples += 1
+                self.latency_sum += latency
+                self.latency_max = max(self.latency_max, latency)
+                self.recent_latencies.append(latency)
+                if cache_hit is True:
+                    self.cache_hits += 1
+                elif cache_hit is False:
+                    self.cache_misses += 1
+
+    def get_metrics_dictionary(self):
+        """Samples in progress beyond the number of workers are waiting in the queue, the rest are running"""
+
+        with self.lock:
+            metrics = {
+                "queue_depth": max(0, self.samples_in_progress - self.workers),
+                "running_samples": min(self.samples_in_progress, self.workers),
+                "processed_samples": self.processed_samples,
+                "failed_samples": self.failed_samples,
+                "cache_hits": self.cache_hits if self.cache_enabled is True else None,
+                "cache_misses": self.cache_misses if self.cache_enabled is True else None,
+                "last_latency_seconds": None,
+                "mean_latency_seconds": None,
+                "recent_mean_latency_seconds": None,
+                "max_latency_seconds": None
+            }
+            if self.processed_samples > 0:
+                metrics["last_latency_seconds"] = round(self.recent_latencies[-1], 3)
+                metrics["mean_latency_seconds"] = round(self.latency_sum / self.processed_samples, 3)
+                metrics["recent_mean_latency_seconds"] = round(
+                    sum(self.recent_latencies) / len(self.recent_latencies), 3)
+                metrics["max_latency_seconds"] = round(self.latency_max, 3)
+        return metrics
+
+
+class TypingRequestHandler(BaseHTTPRequestHandler):
+    """Handles HTTP requests to the typing server. Typing requests are submitted to the worker pool of the server,
+    so request threads only wait for their results
+    """
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.server.metrics.get_metrics_dictionary())
+        else:
+            self.send_json(404, {"error": "Unknown endpoint %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/type":
+            self.send_json(404, {"error": "Unknown endpoint %s" % self.path})
+            return
+        try:
+            body = self.read_request_body()
+        except ValueError:
+            self.send_json(400, {"error": "Malformed chunked request body"})
+            return
+        if body is None:
+            self.send_json(411, {"error": "Request body needs a Content-Length or Transfer-Encoding: chunked"})
+            return
+        if body[:2] == b"\x1f\x8b":  # gzip magic bytes, as checked by KIRtyper open_sam_file for SAM files
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError, zlib.error):
+                self.send_json(400, {"error": "Request body is not valid gzip data"})
+                return
+        try:
+            body = body.decode()
+        except UnicodeDecodeError:
+            self.send_json(400, {"error": "Request body is neither SAM text nor gzipped SAM"})
+            return
+        if body.strip() == "":
+            self.send_json(400, {"error": "Request body is empty"})
+            return
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                sam_file_name = json.loads(body)["sam_file"]
+            except (ValueError, KeyError, TypeError):
+                self.send_json(400, {"error": "JSON body must contain a sam_file path"})
+                return
+            sample_arguments = {"sam_file_name": sam_file_name}
+        else:
+            sample_arguments = {"sam_body": body}
+
+        start_time = time.perf_counter()
+        self.server.metrics.sample_submitted()
+        try:
+            typing_results = self.server.executor.submit(
+                type_sample, collapse_duplicates=self.server.collapse_duplicates, **sample_arguments).result()
+        except (ValueError, OSError) as error:  # Unparseable SAM input or missing SAM file
+            self.server.metrics.sample_finished(time.perf_counter() - start_time, failed=True)
+            self.send_json(400, {"error": str(error)})
+            return
+        except Exception as error:
+            self.server.metrics.sample_finished(time.perf_counter() - start_time, failed=True)
+            self.send_json(500, {"error": "%s: %s" % (type(error).__name__, error)})
+            return
+        latency = time.perf_counter() - start_time
+        self.server.metrics.sample_finished(latency, cache_hit=typing_results["combined_analysis_cache_hit"])
+        typing_results["latency_seconds"] = round(latency, 3)
+        self.send_json(200, typing_results)
+
+    do_PUT = do_POST  # curl -T uploads, the usual way of streaming a body, use PUT
+
+    def read_request_body(self):
+        """Reads the request body, either of Content-Length size or streamed with chunked transfer encoding.
+        Returns None if the request has neither
+        """
+
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            chunk_size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            while chunk_size > 0:
+                chunks.append(self.rfile.read(chunk_size))
+                self.rfile.readline()  # Every chunk ends with a line break
+                chunk_size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            trailer_line = self.rfile.readline()
+            while trailer_line not in (b"\r\n", b"\n", b""):
+                trailer_line = self.rfile.readline()
+            return b"".join(chunks)
+        if "Content-Length" not in self.headers:
+            return None
+        return self.rfile.read(int(self.headers["Content-Length"]))
+
+    def send_json(self, status, content):
+        response = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+if __name__ == "__main__":
+    main()